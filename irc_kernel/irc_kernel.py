@@ -1,14 +1,29 @@
 import argparse
 import asyncio
-import datetime
-import json
+import concurrent.futures
+import functools
+import hmac
+import logging
+import os
 import pathlib
 import random
 import sys
+import time
 import uuid
 
+import orjson
+
+LOGGER = logging.getLogger('irc_kernel')
+LOGGER.addHandler(logging.NullHandler())
+
 
 class Config:
+    __slots__ = ('path', 'data', '_dirty', '_failures', '_flush_handle',
+                 '_executor', '_pending')
+
+    _FLUSH_DELAY = 0.2
+    _MAX_FLUSH_DELAY = 60
+
     def __contains__(self, item):
         return item in self.data
 
@@ -18,17 +33,84 @@ class Config:
     def __init__(self, path):
         self.path = path
         self.data = {}
+        self._dirty = False
+        self._failures = 0
+        self._flush_handle = None
+        # a single worker keeps writes in order
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pending = None
         if self.path.exists():
-            with self.path.open() as f:
-                self.data = json.load(f)
+            self.data = orjson.loads(self.path.read_bytes())
 
     def __setitem__(self, key, value):
         self.data[key] = value
-        self._flush()
+        self.mark_dirty()
 
-    def _flush(self):
-        with self.path.open('w') as f:
-            json.dump(self.data, f, indent=2, sort_keys=True)
+    def _do_flush(self):
+        self._flush_handle = None
+        if not self._dirty:
+            return
+        # serializing here takes the snapshot, only the file i/o is offloaded
+        try:
+            data = dump_config(self.data)
+        except Exception as e:
+            self._flush_failed(e)
+            return
+        self._dirty = False
+        loop = asyncio.get_event_loop()
+        self._pending = self._executor.submit(write_config, self.path, data)
+        self._pending.add_done_callback(
+            functools.partial(self._write_done, loop))
+
+    def _flush_done(self, future):
+        if future is not self._pending:
+            # close() has already dealt with this write
+            return
+        self._pending = None
+        if future.exception() is not None:
+            self._flush_failed(future.exception())
+        elif self._failures:
+            LOGGER.info('** Wrote the config file after %s failed attempts',
+                        self._failures)
+            self._failures = 0
+
+    def _flush_failed(self, exc):
+        # keep the changes and try again later, backing off while it fails
+        self._dirty = True
+        self._failures += 1
+        if self._failures == 1:
+            LOGGER.error('** Failed to write the config file', exc_info=exc)
+        else:
+            LOGGER.debug('** Failed to write the config file again: %s', exc)
+        delay = min(self._FLUSH_DELAY * 2 ** self._failures,
+                    self._MAX_FLUSH_DELAY)
+        self._schedule_flush(delay)
+
+    def _schedule_flush(self, delay):
+        if self._flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self._flush_handle = loop.call_later(delay, self._do_flush)
+
+    def _write_done(self, loop, future):
+        # runs in the worker thread, hand the result back to the loop
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(self._flush_done, future)
+
+    def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._executor.shutdown(wait=True)
+        pending, self._pending = self._pending, None
+        if pending is not None and pending.exception() is not None:
+            self._dirty = True
+        if self._dirty:
+            try:
+                write_config(self.path, dump_config(self.data))
+            except Exception:
+                LOGGER.exception('** Failed to write the config file')
+            else:
+                self._dirty = False
 
     def get(self, key, default=None):
         return self.data.get(key, default)
@@ -36,56 +118,159 @@ class Config:
     def keys(self):
         return self.data.keys()
 
+    def mark_dirty(self):
+        # coalesce bursts of updates into a single write
+        self._dirty = True
+        self._schedule_flush(self._FLUSH_DELAY)
+
     def remove(self, key):
         if key in self.data:
             del self.data[key]
-            self._flush()
+            self.mark_dirty()
 
     def set(self, key, value):
         self[key] = value
-        self._flush()
 
 
-class NewlineDelimitedProtocol(asyncio.Protocol):
+class ReceiveBufferProtocol(asyncio.BufferedProtocol):
 
-    _buf = b''
+    def __init__(self):
+        self._buf = bytearray(65536)
+        self._start = 0
+        self._used = 0
+
+    def buffer_updated(self, nbytes):
+        raise NotImplementedError
+
+    def connection_made(self, transport):
+        # protocol instances can be reused, drop anything left from before
+        self._start = 0
+        self._used = 0
 
     def data_received(self, data):
-        self._buf = self._buf + data
-        lines = self._buf.split(b'\n')
-        self._buf = lines.pop()
-        for line in lines:
-            self.line_received(line.strip())
+        # fallback for transports that do not support buffered protocols
+        buf = self.get_buffer(len(data))
+        buf[:len(data)] = data
+        self.buffer_updated(len(data))
+
+    def get_buffer(self, sizehint):
+        free = len(self._buf) - self._used
+        if free == 0 or free < sizehint:
+            pending = self._used - self._start
+            size = len(self._buf)
+            if size - pending == 0 or size - pending < sizehint:
+                new_buf = bytearray(max(2 * size, pending + sizehint))
+                new_buf[:pending] = self._buf[self._start:self._used]
+                self._buf = new_buf
+            else:
+                self._buf[:pending] = self._buf[self._start:self._used]
+            self._start = 0
+            self._used = pending
+        return memoryview(self._buf)[self._used:]
+
+
+class LengthPrefixedProtocol(ReceiveBufferProtocol):
+
+    max_frame_size = 1 << 20
+
+    def buffer_updated(self, nbytes):
+        buf = self._buf
+        end = self._used + nbytes
+        start = self._start
+        # each frame is a 4-byte big-endian length followed by the payload
+        while end - start >= 4:
+            size = int.from_bytes(buf[start:start + 4], 'big')
+            if size > self.max_frame_size:
+                self._start = 0
+                self._used = 0
+                self.frame_too_large(size)
+                return
+            if end - start - 4 < size:
+                break
+            start += 4
+            with memoryview(buf)[start:start + size] as frame:
+                self.frame_received(frame)
+            start += size
+        if start == end:
+            start = end = 0
+        # a partial frame is left in place until get_buffer needs the room
+        self._start = start
+        self._used = end
+
+    def frame_received(self, frame):
+        raise NotImplementedError
+
+    def frame_too_large(self, size):
+        raise NotImplementedError
+
+
+class NewlineDelimitedProtocol(ReceiveBufferProtocol):
+
+    def buffer_updated(self, nbytes):
+        buf = self._buf
+        end = self._used + nbytes
+        start = self._start
+        # only the newly received bytes can contain a new line ending
+        idx = buf.find(b'\n', self._used, end)
+        with memoryview(buf) as view:
+            while idx >= 0:
+                self.line_received(bytes(view[start:idx]).strip())
+                start = idx + 1
+                idx = buf.find(b'\n', start, end)
+        if start == end:
+            start = end = 0
+        # a partial line is left in place until get_buffer needs the room
+        self._start = start
+        self._used = end
 
     def line_received(self, line):
         raise NotImplementedError
 
 
-class KernelControl(NewlineDelimitedProtocol):
+class KernelControl(LengthPrefixedProtocol):
+
+    _METHODS = {
+        'network.add': 'network_add',
+        'network.connect': 'network_connect',
+        'network.delete': 'network_delete',
+        'network.get': 'network_get',
+        'network.send': 'network_send',
+        'stream.start': 'stream_start',
+        'stream.stop': 'stream_stop',
+    }
+
+    _HANDLER_PREFIX = (b'{"jsonrpc":"2.0","method":"handler",'
+                       b'"params":{"network":')
+    _HANDLER_MESSAGE = b',"message":'
+    _HANDLER_SUFFIX = b'}}'
+    _HANDLER_SIZE = (len(_HANDLER_PREFIX) + len(_HANDLER_MESSAGE) +
+                     len(_HANDLER_SUFFIX))
 
     def __call__(self):
         return self
 
-    def __init__(self, config, verbose=False):
+    def __init__(self, config, loop):
+        super().__init__()
         self.config = config
-        self.verbose = verbose
+        self.loop = loop
+        self._secret = self.config['control']['secret'].encode()
         self._t = None
         self.subscribed = False
         self.clients = {}
         for name, net in self.config['networks'].items():
             client = IRCClient(name, net, self)
-            loop = asyncio.get_event_loop()
-            c = loop.create_connection(client, net['host'], net['port'])
-            asyncio.ensure_future(c)
+            c = self.loop.create_connection(client, net['host'], net['port'])
+            self.loop.create_task(c)
             self.clients[name] = client
 
     def connection_made(self, transport):
+        super().connection_made(transport)
         peername = transport.get_extra_info('peername')
-        self.log('** New control connection from {}'.format(peername))
+        LOGGER.info('[control] ** New control connection from %s', peername)
         self._t = transport
 
     def connection_lost(self, exc):
-        self.log('** Control connection closed')
+        LOGGER.info('[control] ** Control connection closed')
         for c in self.clients.values():
             c.unsubscribe(self.irc_handler)
 
@@ -97,55 +282,40 @@ class KernelControl(NewlineDelimitedProtocol):
             client.out('QUIT')
 
     def dispatch_method(self, msg):
-        if msg.get('jsonrpc') != '2.0':
-            self.control_disconnect()
-            return
-
-        if 'method' not in msg:
-            self.control_disconnect()
-            return
-
+        method = msg.get('method')
         params = msg.get('params')
-        if not isinstance(params, dict):
-            self.control_disconnect()
-            return
-
-        if params.get('secret') == self.config['control']['secret']:
-            method = msg.get('method')
-            if method == 'control.disconnect':
-                self.control_disconnect()
-            if method == 'network.add':
-                return self.network_add(msg)
-            if method == 'network.connect':
-                return self.network_connect(msg)
-            if method == 'network.delete':
-                return self.network_delete(msg)
-            if method == 'network.get':
-                return self.network_get(msg)
-            if method == 'network.send':
-                return self.network_send(msg)
-            if method == 'stream.start':
-                return self.stream_start(msg)
-            if method == 'stream.stop':
-                return self.stream_stop(msg)
-
+        if (msg.get('jsonrpc') == '2.0' and isinstance(method, str) and
+                isinstance(params, dict)):
+            secret = params.get('secret')
+            if (isinstance(secret, str) and
+                    hmac.compare_digest(secret.encode(), self._secret)):
+                handler_name = self._METHODS.get(method)
+                if handler_name is not None:
+                    return getattr(self, handler_name)(msg)
+
+        # control.disconnect, invalid requests and bad secrets all end here
         self.control_disconnect()
         return
 
-    def irc_handler(self, client, msg):
-        self.out({'jsonrpc': '2.0', 'method': 'handler',
-                  'params': {'network': client.name, 'message': msg}})
-
-    def line_received(self, line):
-        try:
-            line = line.decode()
-        except UnicodeDecodeError:
-            self.control_disconnect()
-            return
+    def frame_too_large(self, size):
+        LOGGER.info('[control] ** Frame of %s bytes is too large', size)
+        self.control_disconnect()
 
+    def irc_handler(self, client, msg):
+        # same output as self.out() with a handler notification, without
+        # building the envelope dict for every line from every network
+        name = orjson.dumps(client.name)
+        message = orjson.dumps(msg)
+        size = self._HANDLER_SIZE + len(name) + len(message)
+        # join copies each part once into the finished frame
+        self._t.write(b''.join((size.to_bytes(4, 'big'), self._HANDLER_PREFIX,
+                                name, self._HANDLER_MESSAGE, message,
+                                self._HANDLER_SUFFIX)))
+
+    def frame_received(self, frame):
         try:
-            msg = json.loads(line)
-        except json.JSONDecodeError:
+            msg = orjson.loads(frame)
+        except orjson.JSONDecodeError:
             self.control_disconnect()
             return
 
@@ -160,10 +330,6 @@ class KernelControl(NewlineDelimitedProtocol):
         self.control_disconnect()
         return
 
-    @staticmethod
-    def log(m):
-        log('[control] {}'.format(m))
-
     def network_add(self, msg):
         params = msg.get('params')
         host = params.get('host')
@@ -187,9 +353,8 @@ class KernelControl(NewlineDelimitedProtocol):
         client = IRCClient(name, net, self)
         if self.subscribed:
             client.subscribe(self.irc_handler)
-        loop = asyncio.get_event_loop()
-        c = loop.create_connection(client, host, port)
-        asyncio.ensure_future(c)
+        c = self.loop.create_connection(client, host, port)
+        self.loop.create_task(c)
         self.clients[name] = client
 
         return {'result': 'success', 'id': msg.get('id'), 'jsonrpc': '2.0'}
@@ -208,9 +373,8 @@ class KernelControl(NewlineDelimitedProtocol):
         new_client = IRCClient(name, net, self)
         if self.subscribed:
             new_client.subscribe(self.irc_handler)
-        loop = asyncio.get_event_loop()
-        c = loop.create_connection(new_client, net['host'], net['port'])
-        asyncio.ensure_future(c)
+        c = self.loop.create_connection(new_client, net['host'], net['port'])
+        self.loop.create_task(c)
         self.clients[name] = new_client
         return {'result': 'success', 'id': msg.get('id'), 'jsonrpc': '2.0'}
 
@@ -242,35 +406,29 @@ class KernelControl(NewlineDelimitedProtocol):
             return {'jsonrpc': '2.0', 'id': msg.get('id'),
                     'error': {'code': -32001, 'message': message}}
         message = params.get('message')
+        # client.net is the saved network entry in the config
         if message.lower().startswith('join '):
             chan_list = message.split()[1].split(',')
-            saved_networks = self.config['networks']
-            saved_channels = set(saved_networks[name]['channels'])
-            saved_channels.update(set(chan_list))
-            saved_networks[name]['channels'] = list(saved_channels)
-            self.config['networks'] = saved_networks
+            client.channels.update(chan_list)
+            client.net['channels'] = sorted(client.channels)
+            self.config.mark_dirty()
         elif message.lower().startswith('nick '):
-            new_nick = message.split()[1]
-            saved_networks = self.config['networks']
-            saved_networks[name]['nick'] = new_nick
-            self.config['networks'] = saved_networks
+            client.net['nick'] = message.split()[1]
+            self.config.mark_dirty()
         elif message.lower().startswith('part '):
             chan_list = message.split()[1].split(',')
-            saved_networks = self.config['networks']
-            saved_channels = set(saved_networks[name]['channels'])
-            saved_channels.difference_update(set(chan_list))
-            saved_networks[name]['channels'] = list(saved_channels)
-            self.config['networks'] = saved_networks
+            client.channels.difference_update(chan_list)
+            client.net['channels'] = sorted(client.channels)
+            self.config.mark_dirty()
         client.out(message)
         return {'result': 'success', 'id': msg.get('id'), 'jsonrpc': '2.0'}
 
     def out(self, line):
-        line = json.dumps(line)
-        self._t.write('{}\n'.format(line).encode())
+        payload = orjson.dumps(line, option=orjson.OPT_NON_STR_KEYS)
+        self._t.write(len(payload).to_bytes(4, 'big') + payload)
 
     def stream_start(self, msg):
-        if self.verbose:
-            self.log('** Controller requested to start the stream')
+        LOGGER.debug('[control] ** Controller requested to start the stream')
         self.subscribed = True
         for c in self.clients.values():
             c.subscribe(self.irc_handler)
@@ -286,78 +444,84 @@ class KernelControl(NewlineDelimitedProtocol):
 class IRCClient(NewlineDelimitedProtocol):
 
     def __init__(self, name, net, controller: KernelControl):
-        self._loop = asyncio.get_event_loop()
+        super().__init__()
         self._t = None
         self._subscribers = set()
 
         self.name = name
         self.net = net
+        self.channels = set(net.get('channels', []))
         self.controller = controller
 
     def __call__(self):
         return self
 
     def line_received(self, line):
-        if self.controller.verbose:
-            self.log('<= {!r}'.format(line))
-        line = self.decode(line)
-        for handler in self._subscribers:
-            handler(self, line)
-        tokens = line.split()
-        if len(tokens) > 0 and tokens[0] == 'PING':
-            self.out('PONG ' + tokens[1])
-        elif len(tokens) > 1:
-            if tokens[1] == '376':
-                self.nickserv_identify()
-                self.join_saved_channels()
+        LOGGER.debug('[%s] <= %r', self.name, line)
+        if self._subscribers:
+            decoded = self.decode(line)
+            for handler in self._subscribers:
+                handler(self, decoded)
+        if line[:5] == b'PING ':
+            self.write(b'PONG ' + line[5:] + b'\r\n')
+            return
+        # only the first two tokens are needed, and they are plain ascii
+        tokens = line.split(None, 2)
+        if len(tokens) > 1 and tokens[1] == b'376':
+            self.end_of_motd()
 
     def connection_lost(self, exc):
-        self.log('** Connection lost')
+        LOGGER.info('[%s] ** Connection lost', self.name)
 
     def connection_made(self, transport):
+        super().connection_made(transport)
         peer = transport.get_extra_info('peername')
         self._t = transport
-        if self.controller.verbose:
-            self.log('** Connection made to {}'.format(peer))
-        self.out('NICK ' + self.net['nick'])
-        self.out('USER {} {} x :{}'.format(self.net['user'], self.net['host'],
-                                           self.net['realname']))
+        LOGGER.debug('[%s] ** Connection made to %s', self.name, peer)
+        nick, user = self.net['nick'], self.net['user']
+        host, realname = self.net['host'], self.net['realname']
+        self.out_lines([f'NICK {nick}', f'USER {user} {host} x :{realname}'])
 
     def decode(self, m):
         try:
             return m.decode()
         except UnicodeDecodeError:
-            self.log('** Failed decode using utf-8.')
+            LOGGER.info('[%s] ** Failed decode using utf-8.', self.name)
             pass
         try:
             return m.decode('iso-8859-1')
         except:
-            self.log('** Failed decode using iso-8859-1.')
-            self.log(m)
+            LOGGER.info('[%s] ** Failed decode using iso-8859-1.', self.name)
+            LOGGER.info('[%s] %s', self.name, m)
             raise
 
     def disconnect(self):
         self._t.close()
 
-    def join_saved_channels(self):
-        for channel in self.net['channels']:
-            self.out('JOIN {}'.format(channel))
-
-    def log(self, m):
-        log('[{}] {}'.format(self.name, m))
-
-    def nickserv_identify(self):
+    def end_of_motd(self):
+        # identify and join saved channels in a single write
+        lines = []
         config = self.controller.config['networks'][self.name]
         nickservpass = config.get('nickservpass')
         if nickservpass is not None:
-            self.out('privmsg nickserv :identify {}'.format(nickservpass))
+            lines.append(f'privmsg nickserv :identify {nickservpass}')
+        lines.extend(f'JOIN {channel}' for channel in self.net['channels'])
+        self.out_lines(lines)
 
     def out(self, m):
         if m:
-            m = '{}\r\n'.format(m).encode()
-            if self.controller.verbose:
-                self.log('=> {!r}'.format(m))
-            self._t.write(m)
+            self.write(m.encode() + b'\r\n')
+
+    def out_lines(self, lines):
+        lines = [m.encode() + b'\r\n' for m in lines if m]
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            for m in lines:
+                LOGGER.debug('[%s] => %r', self.name, m)
+        self._t.writelines(lines)
+
+    def write(self, m):
+        LOGGER.debug('[%s] => %r', self.name, m)
+        self._t.write(m)
 
     def subscribe(self, handler):
         self._subscribers.add(handler)
@@ -394,49 +558,71 @@ def generate_config(path: pathlib.Path):
         }
     }
     path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open('w') as f:
-        json.dump(default_config, f, indent=2, sort_keys=True)
+    write_config(path, dump_config(default_config))
+
+
+def dump_config(data):
+    # json.dumps wrote keys such as a missing network name as strings
+    options = (orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS |
+               orjson.OPT_SORT_KEYS)
+    return orjson.dumps(data, option=options)
 
 
-def log(m):
-    t = datetime.datetime.utcnow()
-    print('{} {}'.format(t, m))
-    sys.stdout.flush()
+def configure_logging(verbose=False):
+    handler = logging.StreamHandler(sys.stdout)
+    formatter = logging.Formatter('%(asctime)s %(message)s')
+    formatter.converter = time.gmtime
+    handler.setFormatter(formatter)
+    LOGGER.addHandler(handler)
+    LOGGER.setLevel(logging.DEBUG if verbose else logging.INFO)
+
+
+def write_config(path: pathlib.Path, data: bytes):
+    tmp = path.with_suffix('.tmp')
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
 
 
 def main():
-    log('** Starting up')
     args = parse_args()
-    if args.verbose:
-        log('** Verbose logging is turned on')
+    configure_logging(args.verbose)
+    LOGGER.info('** Starting up')
+    LOGGER.debug('** Verbose logging is turned on')
 
     config_path = pathlib.Path.home() / '.config/irc_kernel/config.json'
     if config_path.exists():
         try:
             c = Config(config_path)
-        except json.JSONDecodeError:
-            log('** The config file is invalid')
+        except orjson.JSONDecodeError:
+            LOGGER.info('** The config file is invalid')
             sys.exit()
     else:
-        log('** No config file found')
+        LOGGER.info('** No config file found')
         generate_config(config_path)
-        log('** I generated a new config file at {}'.format(config_path))
-        log('** Edit it and try again')
+        LOGGER.info('** I generated a new config file at %s', config_path)
+        LOGGER.info('** Edit it and try again')
         sys.exit()
 
-    kc = KernelControl(c, args.verbose)
-    loop = asyncio.get_event_loop()
+    try:
+        import uvloop
+        loop = uvloop.new_event_loop()
+        LOGGER.info('** Using uvloop')
+    except ImportError:
+        loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    kc = KernelControl(c, loop)
     host = c['control']['host']
     port = c['control']['port']
     k = loop.create_server(kc, host, port)
-    log('** Listening for control connections on {}:{}'.format(host, port))
+    LOGGER.info('** Listening for control connections on %s:%s', host, port)
     loop.run_until_complete(k)
 
     try:
         loop.run_forever()
     except KeyboardInterrupt:
-        log('** Shutting down')
+        LOGGER.info('** Shutting down')
         kc.disconnect_all()
+        c.close()
         loop.stop()
 
 if __name__ == '__main__':
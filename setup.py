@@ -4,6 +4,10 @@ setup(
     name='irc-kernel',
     version='0.1',
     packages=find_packages(),
+    install_requires=['orjson'],
+    extras_require={
+        'fast': ['uvloop']
+    },
     entry_points={
         'console_scripts': [
             'irc_kernel = irc_kernel.irc_kernel:main'
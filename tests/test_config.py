@@ -0,0 +1,125 @@
+import asyncio
+import logging
+
+import orjson
+import pytest
+
+from irc_kernel import irc_kernel
+from irc_kernel.irc_kernel import Config
+
+
+@pytest.fixture
+def fast_flush(monkeypatch):
+    monkeypatch.setattr(Config, '_FLUSH_DELAY', 0.01)
+
+
+def flaky_write(monkeypatch, failures):
+    calls = []
+    write_config = irc_kernel.write_config
+
+    def write(path, data):
+        calls.append(data)
+        if len(calls) <= failures:
+            raise OSError(28, 'No space left on device')
+        write_config(path, data)
+
+    monkeypatch.setattr(irc_kernel, 'write_config', write)
+    return calls
+
+
+def test_updates_are_coalesced_into_one_write(tmp_path, monkeypatch,
+                                              fast_flush):
+    path = tmp_path / 'config.json'
+    calls = flaky_write(monkeypatch, 0)
+
+    async def run():
+        c = Config(path)
+        c['a'] = 1
+        c.set('b', 2)
+        c['c'] = 3
+        c.remove('a')
+        assert not path.exists()
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+    assert len(calls) == 1
+    assert orjson.loads(path.read_bytes()) == {'b': 2, 'c': 3}
+    assert not path.with_suffix('.tmp').exists()
+
+
+def test_close_writes_pending_changes(tmp_path):
+    path = tmp_path / 'config.json'
+    path.write_bytes(orjson.dumps({'a': 1}))
+
+    async def run():
+        c = Config(path)
+        c['b'] = 2
+        c.close()
+
+    asyncio.run(run())
+    assert orjson.loads(path.read_bytes()) == {'a': 1, 'b': 2}
+
+
+def test_write_config_replaces_the_file(tmp_path):
+    path = tmp_path / 'config.json'
+    path.write_bytes(b'old')
+    irc_kernel.write_config(path, b'new')
+    assert path.read_bytes() == b'new'
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_failed_write_is_logged_once_and_retried(tmp_path, monkeypatch,
+                                                  fast_flush, caplog):
+    path = tmp_path / 'config.json'
+    calls = flaky_write(monkeypatch, 3)
+
+    async def run():
+        c = Config(path)
+        c['a'] = 1
+        for _ in range(100):
+            await asyncio.sleep(0.02)
+            if path.exists():
+                break
+
+    with caplog.at_level(logging.DEBUG, logger='irc_kernel'):
+        asyncio.run(run())
+    assert len(calls) == 4
+    assert orjson.loads(path.read_bytes()) == {'a': 1}
+    errors = [r for r in caplog.records if r.levelno == logging.ERROR]
+    assert len(errors) == 1
+
+
+def test_serialization_failure_is_retried(tmp_path, fast_flush, caplog):
+    path = tmp_path / 'config.json'
+
+    async def run():
+        c = Config(path)
+        c['bad'] = object()
+        await asyncio.sleep(0.05)
+        assert not path.exists()
+        c.remove('bad')
+        c['a'] = 1
+        for _ in range(100):
+            await asyncio.sleep(0.02)
+            if path.exists():
+                break
+
+    with caplog.at_level(logging.ERROR, logger='irc_kernel'):
+        asyncio.run(run())
+    assert orjson.loads(path.read_bytes()) == {'a': 1}
+    assert len(caplog.records) == 1
+
+
+def test_close_rewrites_after_failed_pending_write(tmp_path, monkeypatch):
+    path = tmp_path / 'config.json'
+    calls = flaky_write(monkeypatch, 1)
+
+    async def run():
+        c = Config(path)
+        c['a'] = 1
+        c._do_flush()
+        c.close()
+
+    asyncio.run(run())
+    assert len(calls) == 2
+    assert orjson.loads(path.read_bytes()) == {'a': 1}
@@ -0,0 +1,168 @@
+import asyncio
+
+import orjson
+import pytest
+
+from irc_kernel.irc_kernel import Config, KernelControl
+
+
+class FakeLoop:
+
+    def __init__(self):
+        self.connections = []
+
+    def create_connection(self, client, host, port):
+        self.connections.append((client.name, host, port))
+
+    def create_task(self, c):
+        pass
+
+
+class FakeTransport:
+
+    def __init__(self):
+        self.closed = False
+        self.data = b''
+
+    def close(self):
+        self.closed = True
+
+    def get_extra_info(self, name):
+        return None
+
+    def write(self, data):
+        self.data += data
+
+
+def make_control(tmp_path):
+    path = tmp_path / 'config.json'
+    path.write_bytes(orjson.dumps({
+        'control': {'secret': 's', 'host': '127.0.0.1', 'port': 0},
+        'networks': {}
+    }))
+    kc = KernelControl(Config(path), FakeLoop())
+    transport = FakeTransport()
+    kc.connection_made(transport)
+    return kc, transport
+
+
+def request(method, id_=1, **params):
+    params.setdefault('secret', 's')
+    return {'jsonrpc': '2.0', 'id': id_, 'method': method, 'params': params}
+
+
+def send(kc, msg):
+    payload = orjson.dumps(msg)
+    kc.data_received(len(payload).to_bytes(4, 'big') + payload)
+
+
+def responses(transport):
+    data, result = transport.data, []
+    while data:
+        size = int.from_bytes(data[:4], 'big')
+        result.append(orjson.loads(data[4:4 + size]))
+        data = data[4 + size:]
+    return result
+
+
+def test_network_add_with_non_string_names(tmp_path):
+    async def run():
+        kc, transport = make_control(tmp_path)
+        send(kc, request('network.add', 1, host='irc.example.com'))
+        send(kc, request('network.add', 2, host='irc.example.com', name=5))
+        send(kc, request('network.get', 3))
+        kc.config.close()
+        return kc, transport
+
+    kc, transport = asyncio.run(run())
+    assert not transport.closed
+    result = responses(transport)
+    assert [r['id'] for r in result] == [1, 2, 3]
+    assert sorted(result[2]['result']) == ['5', 'null']
+    saved = orjson.loads((tmp_path / 'config.json').read_bytes())
+    assert sorted(saved['networks']) == ['5', 'null']
+
+
+def test_dispatch_known_methods(tmp_path):
+    kc, transport = make_control(tmp_path)
+    send(kc, request('network.get', 1))
+    send(kc, request('stream.start', 2))
+    send(kc, request('stream.stop', 3))
+    assert not transport.closed
+    assert responses(transport) == [
+        {'jsonrpc': '2.0', 'id': 1, 'result': {}},
+        {'jsonrpc': '2.0', 'id': 2, 'result': 'success'},
+        {'jsonrpc': '2.0', 'id': 3, 'result': 'success'},
+    ]
+
+
+def test_dispatch_batch(tmp_path):
+    kc, transport = make_control(tmp_path)
+    send(kc, [request('network.get', 1), request('stream.start', 2)])
+    assert responses(transport) == [[
+        {'jsonrpc': '2.0', 'id': 1, 'result': {}},
+        {'jsonrpc': '2.0', 'id': 2, 'result': 'success'},
+    ]]
+
+
+@pytest.mark.parametrize('method', ['control.disconnect', 'network.nope'])
+def test_dispatch_disconnects_on_other_methods(tmp_path, method):
+    kc, transport = make_control(tmp_path)
+    send(kc, request(method))
+    assert transport.closed
+
+
+@pytest.mark.parametrize('secret', ['wrong', '', 'sé', None, 5, ['s']])
+def test_dispatch_rejects_bad_secrets(tmp_path, secret):
+    kc, transport = make_control(tmp_path)
+    send(kc, request('network.get', secret=secret))
+    assert transport.closed
+    assert responses(transport) == [None]
+
+
+def test_dispatch_rejects_missing_secret(tmp_path):
+    kc, transport = make_control(tmp_path)
+    send(kc, {'jsonrpc': '2.0', 'id': 1, 'method': 'network.get',
+              'params': {}})
+    assert transport.closed
+
+
+@pytest.mark.parametrize('msg', [
+    {'jsonrpc': '2.0', 'method': [], 'params': {}},
+    {'jsonrpc': '2.0', 'method': {}, 'params': {'secret': 's'}},
+    {'jsonrpc': '2.0', 'params': {'secret': 's'}},
+    {'jsonrpc': '1.0', 'method': 'network.get', 'params': {'secret': 's'}},
+    {'jsonrpc': '2.0', 'method': 'network.get', 'params': ['s']},
+    'network.get',
+])
+def test_dispatch_rejects_invalid_requests(tmp_path, msg):
+    kc, transport = make_control(tmp_path)
+    send(kc, msg)
+    assert transport.closed
+
+
+def test_invalid_json_disconnects(tmp_path):
+    kc, transport = make_control(tmp_path)
+    kc.data_received(b'\x00\x00\x00\x02{x')
+    assert transport.closed
+
+
+class FakeClient:
+
+    def __init__(self, name):
+        self.name = name
+
+
+@pytest.mark.parametrize('name, message', [
+    ('freenode', ':nick!u@h PRIVMSG #chan :hello'),
+    ('fr"ee\\node', ':nick PRIVMSG #chan :caf\xe9 ☃ "quoted"\t'),
+    (None, ''),
+])
+def test_irc_handler_matches_out(tmp_path, name, message):
+    kc, transport = make_control(tmp_path)
+    kc.irc_handler(FakeClient(name), message)
+    handler_frame = transport.data
+    transport.data = b''
+    kc.out({'jsonrpc': '2.0', 'method': 'handler',
+            'params': {'network': name, 'message': message}})
+    assert handler_frame == transport.data
@@ -0,0 +1,76 @@
+from irc_kernel.irc_kernel import IRCClient
+
+
+class FakeController:
+
+    def __init__(self, net):
+        self.config = {'networks': {'net': net}}
+
+
+class FakeTransport:
+
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    def writelines(self, lines):
+        self.data += b''.join(lines)
+
+
+def make_client(nickservpass=None, channels=()):
+    net = {'channels': list(channels), 'nickservpass': nickservpass}
+    client = IRCClient('net', net, FakeController(net))
+    client._t = FakeTransport()
+    return client
+
+
+def test_end_of_motd_identifies_and_joins():
+    client = make_client('hunter2', ['#a', '#b'])
+    client.line_received(b':irc.example.com 376 me :End of /MOTD command.')
+    assert client._t.data == (b'privmsg nickserv :identify hunter2\r\n'
+                              b'JOIN #a\r\nJOIN #b\r\n')
+
+
+def test_end_of_motd_without_nickserv():
+    client = make_client(channels=['#a'])
+    client.line_received(b':irc.example.com 376 me :End of /MOTD command.')
+    assert client._t.data == b'JOIN #a\r\n'
+
+
+def test_other_lines_send_nothing():
+    client = make_client(channels=['#a'])
+    client.line_received(b':nick PRIVMSG #a :376 PING')
+    client.line_received(b'')
+    assert client._t.data == b''
+
+
+def test_subscribers_get_decoded_lines():
+    client = make_client()
+    received = []
+    client.subscribe(lambda c, line: received.append(line))
+    client.line_received(b':a PRIVMSG #a :caf\xc3\xa9')
+    client.line_received(b':a PRIVMSG #a :caf\xe9')
+    assert received == [':a PRIVMSG #a :caf\xe9'] * 2
+
+
+def test_ping_is_answered_with_pong():
+    client = make_client()
+    client.line_received(b'PING :irc.example.com')
+    assert client._t.data == b'PONG :irc.example.com\r\n'
+
+
+def test_ping_is_passed_to_subscribers():
+    client = make_client()
+    received = []
+    client.subscribe(lambda c, line: received.append(line))
+    client.line_received(b'PING :irc.example.com')
+    assert received == ['PING :irc.example.com']
+    assert client._t.data == b'PONG :irc.example.com\r\n'
+
+
+def test_ping_from_a_user_is_not_answered():
+    client = make_client()
+    client.line_received(b':nick PRIVMSG me :PING 12345')
+    assert client._t.data == b''
@@ -0,0 +1,108 @@
+import random
+
+import pytest
+
+from irc_kernel.irc_kernel import (LengthPrefixedProtocol,
+                                   NewlineDelimitedProtocol)
+
+
+class LineCollector(NewlineDelimitedProtocol):
+
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def line_received(self, line):
+        self.lines.append(line)
+
+
+class FrameCollector(LengthPrefixedProtocol):
+
+    def __init__(self):
+        super().__init__()
+        self.frames = []
+        self.too_large = []
+
+    def frame_received(self, frame):
+        self.frames.append(bytes(frame))
+
+    def frame_too_large(self, size):
+        self.too_large.append(size)
+
+
+def feed(protocol, data, rng):
+    # mimic a transport: ask for a buffer, fill part of it, report the size
+    i = 0
+    while i < len(data):
+        buf = protocol.get_buffer(rng.choice([-1, 0, rng.randint(1, 64)]))
+        n = min(rng.randint(1, 64), len(buf), len(data) - i)
+        buf[:n] = data[i:i + n]
+        del buf
+        protocol.buffer_updated(n)
+        i += n
+
+
+def frame(payload):
+    return len(payload).to_bytes(4, 'big') + payload
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_newline_random_chunks(seed):
+    rng = random.Random(seed)
+    lines = [b'line %d ' % i + b'x' * rng.randint(0, 300) for i in range(300)]
+    protocol = LineCollector()
+    protocol._buf = bytearray(rng.randint(1, 128))
+    feed(protocol, b''.join(line + b'\r\n' for line in lines) + b'tail', rng)
+    assert protocol.lines == [line.strip() for line in lines]
+    protocol.data_received(b'\n')
+    assert protocol.lines[-1] == b'tail'
+
+
+def test_newline_line_larger_than_buffer():
+    protocol = LineCollector()
+    protocol.data_received(b'x' * 200000 + b'\r\nnext\n')
+    assert protocol.lines == [b'x' * 200000, b'next']
+
+
+def test_newline_connection_made_drops_partial_line():
+    protocol = LineCollector()
+    protocol.data_received(b'partial')
+    protocol.connection_made(None)
+    protocol.data_received(b'ok\n')
+    assert protocol.lines == [b'ok']
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_length_prefixed_random_chunks(seed):
+    rng = random.Random(seed)
+    payloads = [b'{"n":%d,"x":"%s"}' % (i, b'x' * rng.randint(0, 300))
+                for i in range(300)]
+    protocol = FrameCollector()
+    protocol._buf = bytearray(rng.randint(1, 128))
+    feed(protocol, b''.join(frame(p) for p in payloads) + b'\x00\x00', rng)
+    assert protocol.frames == payloads
+    protocol.data_received(b'\x00\x00')
+    assert protocol.frames[-1] == b''
+
+
+def test_length_prefixed_frame_larger_than_buffer():
+    protocol = FrameCollector()
+    protocol.data_received(frame(b'x' * 200000) + frame(b'next'))
+    assert protocol.frames == [b'x' * 200000, b'next']
+
+
+def test_length_prefixed_frame_too_large():
+    protocol = FrameCollector()
+    protocol.data_received(b'\xff\xff\xff\xff' + b'x' * 100)
+    assert protocol.too_large == [0xffffffff]
+    assert protocol.frames == []
+    protocol.data_received(frame(b'ok'))
+    assert protocol.frames == [b'ok']
+
+
+def test_length_prefixed_connection_made_drops_partial_frame():
+    protocol = FrameCollector()
+    protocol.data_received(b'\x00\x00\x10')
+    protocol.connection_made(None)
+    protocol.data_received(frame(b'ok'))
+    assert protocol.frames == [b'ok']